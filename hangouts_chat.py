@@ -1,26 +1,40 @@
-import json
-import httplib2
+import datetime
 import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 from typing import Iterable, Optional
 from errbot.backends.base import Message, Card
 from errbot.backends.base import Person
 from errbot.backends.base import Room, RoomError
 from errbot.errBot import ErrBot
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.cloud import pubsub
-from oauth2client.service_account import ServiceAccountCredentials
-from cachetools import LRUCache
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+from cachetools import LRUCache, TTLCache
 
+try:
+    # orjson is considerably faster and reads/writes UTF-8 bytes directly
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
 
 from markdownconverter import hangoutschat_markdown_converter
 from prometheus import PrometheusMetrics
 
 log = logging.getLogger('errbot.backends.hangoutschat')
 
-
-def removeprefix(source: str, prefix: str):
-    if source.startswith(prefix):
-        return source[len(prefix):]
-    return source
+# Anything the markdown converter may rewrite: markdown/HTML syntax, list and heading
+# markers at the start of a line, tabs, and whitespace it strips around lines
+MARKDOWN_TOKENS_REGEX = re.compile(r'[*_`~\[\]#>|\\<&{}\t]|^\s|\s$|^(?:[-+=:]|\d+[.)])', re.MULTILINE)
 
 
 class RoomsNotSupportedError(RoomError):
@@ -42,6 +56,28 @@ class MalformedCardError(Exception):
         ))
 
 
+class BoundedSet:
+    """
+    A set that only remembers recently added keys. Keys are added to the current
+    generation; once it holds maxsize keys it replaces the previous generation,
+    so between maxsize and 2 * maxsize of the latest keys are kept
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._current = set()
+        self._previous = set()
+
+    def add(self, key):
+        if len(self._current) >= self.maxsize:
+            self._previous = self._current
+            self._current = set()
+        self._current.add(key)
+
+    def __contains__(self, key):
+        return key in self._current or key in self._previous
+
+
 class GoogleHangoutsChatAPI:
     """
     Represents the Google Hangouts REST API
@@ -54,50 +90,182 @@ class GoogleHangoutsChatAPI:
     # Maximum length of any single message sent to google chat
     max_message_length = 4096
 
-    def __init__(self, creds_file: str, scope: str = 'https://www.googleapis.com/auth/chat.bot'):
+    # Size of the keep-alive connection pool kept open to the Chat API
+    pool_connections = 4
+    pool_maxsize = 20
+
+    # Shared by every request, the transport copies headers rather than mutating them
+    _default_headers = {'Content-Type': 'application/json; charset=UTF-8', }
+
+    # Rate limited and transient server errors are retried with exponential backoff,
+    # for at most max_retry_time seconds in total
+    retry_statuses = frozenset((429, 500, 502, 503, 504))
+    max_attempts = 8
+    max_backoff = 60
+    max_retry_time = 30
+
+    # Access tokens are refreshed in the background this long before they expire
+    token_refresh_margin = datetime.timedelta(minutes=5)
+    token_refresh_retry = 30
+
+    def __init__(self, creds_file: str, scope: str = 'https://www.googleapis.com/auth/chat.bot',
+                 token_cache_file: str = None):
         self.creds_file = creds_file
         self.scope = scope
+        # Optional file the access token is kept in, so a restart can skip the token grant
+        self.token_cache_file = token_cache_file
+        # Built once and reused so that every REST call shares the same pooled
+        # connections instead of re-reading the keyfile and re-doing the TLS handshake
+        self._creds = None
+        self._session = None
+        # The lazily built credentials and session are first used from several threads
+        self._init_lock = threading.RLock()
+        # Fetches the next page of a listing while the caller consumes the current one
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=self.pool_connections,
+                                                 thread_name_prefix='ghc-prefetch')
+        self._closed = threading.Event()
+        self._token_refresher = None
 
     @property
     def credentials(self):
-        return ServiceAccountCredentials.from_json_keyfile_name(self.creds_file,
-                                                                scopes=[self.scope])
+        if self._creds is None:
+            with self._init_lock:
+                if self._creds is None:
+                    creds = service_account.Credentials.from_service_account_file(self.creds_file,
+                                                                                  scopes=[self.scope])
+                    if self.token_cache_file:
+                        self._load_token(creds)
+                    self._creds = creds
+        return self._creds
+
+    def _load_token(self, creds):
+        try:
+            with open(self.token_cache_file, 'rb') as f:
+                cached = json_loads(f.read())
+            token = cached['token']
+            expiry = datetime.datetime.fromisoformat(cached['expiry'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        # google-auth keeps expiry as a naive UTC datetime and checks it before use
+        creds.token = token
+        creds.expiry = expiry
+
+    def _save_token(self, creds):
+        data = json_dumps({'token': creds.token, 'expiry': creds.expiry.isoformat()})
+        if isinstance(data, str):
+            # The stdlib json fallback returns str, orjson returns bytes
+            data = data.encode()
+        tmp_file = f'{self.token_cache_file}.tmp'
+        # The token is a bearer credential, keep it readable by the bot user only
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, self.token_cache_file)
+        except OSError:
+            os.unlink(tmp_file)
+            raise
+
+    def _refresh_token(self, creds, request):
+        creds.refresh(request)
+        if self.token_cache_file:
+            try:
+                self._save_token(creds)
+            except OSError:
+                log.exception("Failed to cache access token")
+
+    def _refresh_token_forever(self):
+        """
+        Refreshes the access token shortly before it expires, so requests never
+        have to wait on a token grant
+        """
+        request = Request()
+        delay = 0
+        while not self._closed.wait(delay):
+            creds = self.credentials
+            if creds.token and creds.expiry:
+                delay = (creds.expiry - self.token_refresh_margin - datetime.datetime.utcnow()).total_seconds()
+                if delay > 0:
+                    continue
+            try:
+                self._refresh_token(creds, request)
+                delay = 0
+            except Exception:
+                log.exception("Failed to refresh access token")
+                delay = self.token_refresh_retry
 
     @property
     def client(self):
-        return self.credentials.authorize(httplib2.Http())
-
-    def _request(self, uri: str, query_string: str = None, **kwargs) -> Optional[dict]:
-        request_args = {
-            'method': 'GET',
-            'headers': {'Content-Type': 'application/json; charset=UTF-8', }}
-        request_args.update(kwargs)
-        url = '{}/{}'.format(self.base_url, uri)
-        if query_string:
-            url += '?{}'.format(query_string)
-        result, content = self.client.request(
-            uri=url,
-            **request_args
-        )
-        if result['status'] == '200':
-            content_json = json.loads(content.decode('utf-8'))
+        # AuthorizedSession attaches the bearer token and refreshes it when it expires
+        if self._session is None:
+            with self._init_lock:
+                if self._session is None:
+                    creds = self.credentials
+                    # Get the first token here rather than on the first request, so the
+                    # refresher starts out waiting for it to expire instead of granting another
+                    if not creds.valid:
+                        self._refresh_token(creds, Request())
+                    session = AuthorizedSession(creds)
+                    session.mount('https://', HTTPAdapter(pool_connections=self.pool_connections,
+                                                          pool_maxsize=self.pool_maxsize))
+                    self._token_refresher = threading.Thread(target=self._refresh_token_forever,
+                                                             name='ghc-token-refresh', daemon=True)
+                    self._token_refresher.start()
+                    self._session = session
+        return self._session
+
+    def close(self):
+        self._closed.set()
+        self._prefetch_pool.shutdown(wait=True)
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _request(self, uri: str, params: dict = None, method: str = 'GET',
+                 data: bytes = None) -> Optional[dict]:
+        # params are url-encoded by the session, so tokens and thread keys are escaped
+        url = f'{self.base_url}/{uri}'
+        deadline = time.monotonic() + self.max_retry_time
+        for attempt in range(self.max_attempts):
+            response = self.client.request(
+                method,
+                url,
+                params=params,
+                data=data,
+                headers=self._default_headers
+            )
+            if response.status_code not in self.retry_statuses or attempt == self.max_attempts - 1:
+                break
+            delay = self._retry_delay(response, attempt)
+            if time.monotonic() + delay > deadline:
+                break
+            log.warning('status: {}, retrying in {:.1f}s'.format(response.status_code, delay))
+            time.sleep(delay)
+        if response.status_code == 200:
+            content_json = json_loads(response.content)
             return content_json
         else:
-            log.error('status: {}, content: {}'.format(result['status'], content))
+            log.error('status: {}, content: {}'.format(response.status_code, response.content))
             return None
 
+    def _retry_delay(self, response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(self.max_backoff, int(retry_after))
+        return min(self.max_backoff, 2 ** attempt + random.random())
+
     def _download(self, uri: str) -> Optional[bytes]:
         request_args = {
             'method': 'GET',
             'headers': {'Content-Type': 'application/octet-stream', }}
-        result, content = self.client.request(
-            uri=uri,
+        response = self.client.request(
+            url=uri,
             **request_args
         )
-        if result['status'] == '200':
-            return content
+        if response.status_code == 200:
+            return response.content
         else:
-            log.error('status: {}, content: {}'.format(result['status'], content))
+            log.error('status: {}, content: {}'.format(response.status_code, response.content))
             return None
 
     def _list(self, resource: str, return_attr: str, next_page_token: str = '') -> Iterable[dict]:
@@ -108,50 +276,64 @@ class GoogleHangoutsChatAPI:
             resource: name of resource to list
             return_attr: name of attribute in the root of the response to get
                         resources from
-            next_page_token: the nextPageToken returned by the previous call
+            next_page_token: the nextPageToken to start listing from
 
         Yields:
             dict: the next found resource
         """
 
-        query_string = 'pageSize={}'.format(self.page_size)
-        if next_page_token:
-            query_string += '&pageToken={}'.format(next_page_token)
-        data = self._request(resource, query_string=query_string)
-        if data:
-            for itm in data[return_attr]:
-                yield itm
+        # Page tokens only come with the previous page, so pages can't be fetched in
+        # parallel. Instead the next page is requested before yielding the current one.
+        page = self._fetch_page(resource, next_page_token)
+        while page is not None:
+            data = page.result()
+            if not data:
+                return
+            # The last page either omits nextPageToken or returns it empty
             next_page_token = data.get('nextPageToken')
-            if next_page_token != '':
-                yield from self._list(resource, return_attr, next_page_token)
+            page = self._fetch_page(resource, next_page_token) if next_page_token else None
+            yield from data.get(return_attr, [])
+
+    def _fetch_page(self, resource: str, page_token: str):
+        params = {'pageSize': self.page_size}
+        if page_token:
+            params['pageToken'] = page_token
+        return self._prefetch_pool.submit(self._request, resource, params)
 
     def get_spaces(self) -> Iterable[dict]:
         return self._list('spaces', 'spaces')
 
     def get_space(self, name: str) -> Optional[dict]:
-        return self._request('spaces/{}'.format(removeprefix(name, 'spaces/')))
+        return self.get_space_by_uri(f"spaces/{name.removeprefix('spaces/')}")
+
+    def get_space_by_uri(self, uri: str) -> Optional[dict]:
+        """
+        Like get_space, for callers that already hold the 'spaces/<id>' resource name
+        """
+        return self._request(uri)
 
     def get_members(self, space_name: str) -> Iterable[dict]:
-        return self._list('spaces/{}/members'.format(removeprefix(space_name, 'spaces/')), 'memberships')
+        return self._list(f"spaces/{space_name.removeprefix('spaces/')}/members", 'memberships')
 
     def get_member(self, space_name: str, name: str) -> Optional[dict]:
-        return self._request('spaces/{}/members/{}'.format(removeprefix(space_name, 'spaces/'), name))
+        return self._request(f"spaces/{space_name.removeprefix('spaces/')}/members/{name}")
 
     def create_message(self, space_name: str, body: dict, thread_state: str = None, thread_key: str = None) -> Optional[dict]:
-        url = 'spaces/{}/messages'.format(removeprefix(space_name, 'spaces/'))
-        
+        url = f"spaces/{space_name.removeprefix('spaces/')}/messages"
+        # Creating a message is not idempotent. Retries reuse the same requestId, so a
+        # retry after the message was already stored returns it instead of posting it again
+        params = {'requestId': str(uuid.uuid4())}
+
         # If using a thread key, set messageReplyOption and thread key querystring
         if thread_key is not None:
-            return self._request(url, body=json.dumps(body), method='POST',
-                                    query_string='threadKey={}&messageReplyOption={}'.format(thread_key, 'REPLY_MESSAGE_FALLBACK_TO_NEW_THREAD'))
-        
+            params['threadKey'] = thread_key
+            params['messageReplyOption'] = 'REPLY_MESSAGE_FALLBACK_TO_NEW_THREAD'
+
         # if space is using new threading and there is a thread_id set, set messageReplyOption to keep messages in that thread
-        if thread_state == 'THREADED_MESSAGES' and body.get('thread', {}).get('name', '') != '':
-            return self._request(url, body=json.dumps(body), method='POST',
-                                    query_string='messageReplyOption={}'.format('REPLY_MESSAGE_FALLBACK_TO_NEW_THREAD'))
-        
-        # otherwise, post the message
-        return self._request(url, body=json.dumps(body), method='POST')
+        elif thread_state == 'THREADED_MESSAGES' and (body.get('thread') or {}).get('name'):
+            params['messageReplyOption'] = 'REPLY_MESSAGE_FALLBACK_TO_NEW_THREAD'
+
+        return self._request(url, params, 'POST', json_dumps(body))
 
 class HangoutsChatRoom(Room):
     """
@@ -162,12 +344,26 @@ class HangoutsChatRoom(Room):
         super().__init__()
         self.space_id = space_id
         self.chat_api = chat_api
-        self._load()
+        self._uri = f"spaces/{space_id.removeprefix('spaces/')}"
+        # Fetched on first use, callers that only need space_id never pay for the lookup
+        self._space = None
 
     def _load(self):
-        space = self.chat_api.get_space(self.space_id)
-        self.does_exist = bool(space)
-        self.display_name = space.get('displayName','') if self.does_exist else ''
+        if self._space is None:
+            # Failed lookups aren't kept, so the next access tries again
+            space = self.chat_api.get_space_by_uri(self._uri)
+            if not space:
+                return {}
+            self._space = space
+        return self._space
+
+    @property
+    def does_exist(self):
+        return bool(self._load())
+
+    @property
+    def display_name(self):
+        return self._load().get('displayName', '')
 
     def join(self, username=None, password=None):
         raise RoomsNotSupportedError()
@@ -195,26 +391,28 @@ class HangoutsChatRoom(Room):
 
     @property
     def occupants(self):
-        memberships = self.chat_api.get_members(self.space_id)
-        occupants = []
-        for membership in memberships:
-            name = '{} ({} / {})'.format(membership['member']['displayName'],
-                                         membership['member']['name'],
-                                         membership['state'])
-            if membership['member']['type'] == 'BOT':
-                name += ' **BOT**'
-            occupants.append(HangoutsChatUser(name,
-                                              membership['member']['displayName'],
-                                              None,
-                                              membership['member']['type']))
+        return list(self.iter_occupants())
 
-        return occupants
+    def iter_occupants(self):
+        """
+        Lazily yields occupants as pages of memberships arrive, for large spaces
+        """
+        for membership in self.chat_api.get_members(self.space_id):
+            member = membership['member']
+            display_name = member['displayName']
+            user_type = member['type']
+            name = f"{display_name} ({member['name']} / {membership['state']})"
+            if user_type == 'BOT':
+                name += ' **BOT**'
+            yield HangoutsChatUser(name, display_name, None, user_type)
 
     def invite(self, *args):
         raise RoomsNotSupportedError()
 
 
 class HangoutsChatUser(Person):
+    __slots__ = ('name', 'display_name', 'email', 'user_type')
+
     def __init__(self, name, display_name, email, user_type):
         super().__init__()
         self.name = name
@@ -244,6 +442,22 @@ class HangoutsChatUser(Person):
 
 
 class GoogleHangoutsChatBackend(ErrBot):
+    # Pub/Sub flow control: maximum number and size of events leased at any one time.
+    # Callbacks keep their lease until the event is in the bounded message queue, so
+    # while the message workers are behind Pub/Sub holds back further events
+    pubsub_max_messages = 32
+    pubsub_max_bytes = 10 * 1024 * 1024
+    # Number of threads running event callbacks concurrently
+    pubsub_callback_workers = 8
+    # Number of threads handing incoming messages to errbot and its plugins
+    message_workers = 4
+    # Maximum number of incoming messages waiting for a worker
+    message_queue_size = 32
+    # Seconds to wait for the message workers to finish when shutting down
+    message_shutdown_timeout = 5
+    # Seconds to wait for the subscriber to shut down after being cancelled
+    pubsub_shutdown_timeout = 5
+
     def __init__(self, config):
         super().__init__(config)
         identity = config.BOT_IDENTITY
@@ -252,10 +466,42 @@ class GoogleHangoutsChatBackend(ErrBot):
         self.gce_project = identity['GOOGLE_CLOUD_ENGINE_PROJECT']
         self.gce_topic = identity['GOOGLE_CLOUD_ENGINE_PUBSUB_TOPIC']
         self.gce_subscription = identity['GOOGLE_CLOUD_ENGINE_PUBSUB_SUBSCRIPTION']
-        self.chat_api = GoogleHangoutsChatAPI(self.creds_file)
+        self.chat_api = GoogleHangoutsChatAPI(self.creds_file,
+                                              token_cache_file=identity.get('GOOGLE_TOKEN_CACHE_FILE'))
         self.bot_identifier = HangoutsChatUser(None, self.at_name, None, None)
-        self.event_cache = LRUCache(1024)
+        # Seen events only matter for the Pub/Sub redelivery window, so only the most
+        # recent ones are remembered, regardless of how often they are redelivered
+        self.event_cache = BoundedSet(4096)
+        self.event_cache_lock = threading.Lock()
+        # Recent senders, so a user posting in bursts reuses the same identifier object
+        self.sender_cache = LRUCache(256)
+        self.sender_cache_lock = threading.Lock()
+        # Rooms looked up by query_room, to avoid fetching the same space over and over
+        self.room_cache = TTLCache(maxsize=256, ttl=600)
+        self.room_cache_lock = threading.Lock()
         self.md = hangoutschat_markdown_converter()
+        # Converted bodies keyed on the raw markdown, so repeated notices skip the parser.
+        # The Markdown instance is not thread safe, so conversions are serialized
+        self.md_cache = LRUCache(512)
+        self.md_lock = threading.Lock()
+        # Outbound messages are posted from a small pool so callers don't block on every
+        # round trip. Each space has its own queue of pending sends, and only its head
+        # is on the pool, so sends keep their order without idling a worker
+        self.send_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ghc-send')
+        self.pending_sends = {}
+        self.pending_sends_lock = threading.Lock()
+        # Incoming messages are queued by the Pub/Sub callbacks and dispatched to
+        # plugins by worker threads, so slow commands don't hold up event delivery.
+        # The queue is bounded and callbacks wait for room in it before acking
+        self.message_queue = queue.Queue(maxsize=self.message_queue_size)
+        self.message_threads = []
+        # Created on first subscribe and kept, its gRPC channels are expensive to set up
+        self.subscriber = None
+
+        # Event callbacks run concurrently, up to the flow control limits. They only decode
+        # events and queue messages, and every cache they touch is lock protected
+        self.pubsub_max_messages = int(getattr(config, 'PUBSUB_MAX_MESSAGES', self.pubsub_max_messages))
+        self.pubsub_max_bytes = int(getattr(config, 'PUBSUB_MAX_BYTES', self.pubsub_max_bytes))
 
         # Initialize prometheus metrics if metrics port is configured
         self.prometheus = None
@@ -263,10 +509,16 @@ class GoogleHangoutsChatBackend(ErrBot):
             self.prometheus = PrometheusMetrics(self.at_name, int(config.METRICS_PORT))
 
     def _subscribe_to_pubsub_topic(self, project, topic_name, subscription_name, callback):
-        subscriber = pubsub.SubscriberClient()
+        if self.subscriber is None:
+            self.subscriber = pubsub.SubscriberClient()
         subscription_name = 'projects/{}/subscriptions/{}'.format(project, subscription_name)
+        flow_control = pubsub.types.FlowControl(max_messages=self.pubsub_max_messages,
+                                                max_bytes=self.pubsub_max_bytes)
+        scheduler = ThreadScheduler(executor=ThreadPoolExecutor(max_workers=self.pubsub_callback_workers,
+                                                                thread_name_prefix='ghc-event'))
         log.info("Subscribed to {}".format(subscription_name))
-        return subscriber.subscribe(subscription_name, callback=callback)
+        return self.subscriber.subscribe(subscription_name, callback=callback,
+                                         flow_control=flow_control, scheduler=scheduler)
 
     def _event_cache_format_key(self, event_data):
         event_time = event_data.get('eventTime', 0)
@@ -275,53 +527,66 @@ class GoogleHangoutsChatBackend(ErrBot):
 
         event_type = event_data.get('type', 'NO_EVENT_TYPE_PROVIDED_BY_GHC')
 
-        space_name = event_data.get('space', {}).get('name', '')
+        space_name = (event_data.get('space') or {}).get('name', '')
 
         # eventTime does not change for CARD_CLICKED events when events are generated by multiple clicks on the same card
         # seems like it should, but it does not.  So message.lastUpdateTime must also be used in key to avoid missing event
-        message_last_update_time = event_data.get('message', {}).get('lastUpdateTime', 'NO_MESSAGE_LASTUPDATETIME_PROVIDED_BY_GHC')
+        message_last_update_time = (event_data.get('message') or {}).get('lastUpdateTime', 'NO_MESSAGE_LASTUPDATETIME_PROVIDED_BY_GHC')
 
-        return "{}{}{}{}".format(event_time, event_type, space_name, message_last_update_time)
+        # A tuple hashes and compares field by field without building a joined string
+        return (event_time, event_type, space_name, message_last_update_time)
 
     def _handle_event(self, event):
         try:
-            data = json.loads(event.data.decode('utf-8'))
+            data = json_loads(event.data)
         except Exception:
             log.warning('Received malformed event: {}'.format(event.data))
             event.ack()
             return
 
-        event.ack()
-        # event.ack() may fail silently, so we should ensure our messages are somewhat idempotent
-        event_key = self._event_cache_format_key(data)
-        log.info("event received: %s", event_key)
-        cached = self.event_cache.get(event_key)
-        if cached is not None:
-            return
-        self.event_cache[event_key] = True
+        # Events are acked once handled, for messages once they are queued for the
+        # workers. Until then they count against the Pub/Sub flow control limits
+        try:
+            return self._dispatch_event(data)
+        finally:
+            event.ack()
 
+    def _dispatch_event(self, data):
         # https://developers.google.com/chat/reference/message-formats/events
         # https://developers.google.com/chat/how-tos/cards-onclick#receiving_user_click_information
+        # Pick the handler first, so events we ignore never reach the de-duplication cache
         event_type = data.get('type')
         if event_type == 'MESSAGE':
-            return self.handle_event_MESSAGE(data)
+            handler = self.handle_event_MESSAGE
         elif event_type == 'CARD_CLICKED':
-            return self.handle_event_CARD_CLICKED(data)
-        elif data.get('message', {}).get('text') is not None:
+            handler = self.handle_event_CARD_CLICKED
+        elif (data.get('message') or {}).get('text') is not None:
             # CARD_CLICKED events do not contain data.message.text field
             log.warn(f"Event type '{event_type}' received, handling as 'MESSAGE' type to support previous backend implementation."
                      "If your code relies on handling this event type as a 'MESSAGE' type, please update your code as this will eventually be deprecated."
                      "You will also need to add an event handler for the specific event type to this backend codebase.")
-            return self.handle_event_MESSAGE(data)
+            handler = self.handle_event_MESSAGE
         else:
             log.info(f"Unsupported event type '{event_type}' received")
             return
 
+        # event.ack() may fail silently, so we should ensure our messages are somewhat idempotent.
+        # event_cache only records which events were seen, for redelivery after a lost ack
+        event_key = self._event_cache_format_key(data)
+        log.info("event received: %s", event_key)
+        with self.event_cache_lock:
+            if event_key in self.event_cache:
+                return
+            self.event_cache.add(event_key)
+
+        return handler(data)
+
     # https://developers.google.com/chat/how-tos/cards-onclick
     def handle_event_CARD_CLICKED(self, data):
-        action_method_name = data.get('action', {}).get('actionMethodName')
+        action = data.get('action') or {}
+        action_method_name = action.get('actionMethodName')
         log.info(f"'CARD_CLICKED' event with actionMethodName '{action_method_name}' received")
-        action_params = {p['key']: p['value'] for p in data.get('action', {}).get('parameters', [])}
+        action_params = {p['key']: p['value'] for p in action.get('parameters', [])}
 
         # this can be extended to handle any arbitrary action_method_names
         if action_method_name == 'bot_command':
@@ -330,58 +595,200 @@ class GoogleHangoutsChatBackend(ErrBot):
             if command is None:
                 log.error("Required 'command' parameter missing for 'bot_command' actionMethodName")
                 return
-            MESSAGE_data = dict(data)
-            MESSAGE_data['message']['text'] = f"{command} {command_args}"
+            # Rebuild only the levels that change, dict(data) would share and mutate data['message']
+            MESSAGE_data = {**data, 'message': {**data['message'], 'text': f"{command} {command_args}"}}
             self.handle_event_MESSAGE(MESSAGE_data)
         else:
             log.info(f"Unsupported CARD_CLICKED event action method name '{action_method_name}' received")
 
+    def _get_sender(self, sender_blob):
+        sender_key = (sender_blob.get('name', ''),
+                      sender_blob.get('displayName', ''),
+                      sender_blob.get('email', ''),
+                      sender_blob.get('type', ''))
+        with self.sender_cache_lock:
+            sender = self.sender_cache.get(sender_key)
+            if sender is None:
+                sender = HangoutsChatUser(*sender_key)
+                self.sender_cache[sender_key] = sender
+        return sender
+
     def handle_event_MESSAGE(self, data):
         # https://developers.google.com/chat/api/guides/message-formats/events#message
-        sender_blob = data.get('message', {}).get('sender', {})
-        sender = HangoutsChatUser(sender_blob.get('name', ''),
-                                  sender_blob.get('displayName', ''),
-                                  sender_blob.get('email', ''),
-                                  sender_blob.get('type', ''))
-        message_body = data['message'].get('text','')
+        message = data['message']
+        space = data['space']
+        sender = self._get_sender(message.get('sender') or {})
+        message_body = message.get('text','')
         context = {
-            'space_id': data['space']['name'],
-            'thread_id': data['message']['thread']['name'],
-            'thread_state': data['space']['spaceThreadingState']
+            'space_id': space['name'],
+            'thread_id': message['thread']['name'],
+            'thread_state': space['spaceThreadingState']
         }
 
-        if 'attachment' in data['message']:
-            context['attachment'] = data['message']['attachment']
-        # pass httplib2.Http() authenticated handler to errbot. uselful to download attachments
+        if 'attachment' in message:
+            context['attachment'] = message['attachment']
+        # pass the authenticated session download handler to errbot. useful to download attachments
         context['downloader'] = self.chat_api._download
 
         msg = Message(body=message_body.strip(), frm=sender, extras=context)
 
-        is_dm = data['message']['space']['type'] == 'DM'
+        is_dm = message['space']['type'] == 'DM'
         if is_dm:
             msg.to = self.bot_identifier
 
-        self.callback_message(msg)
+        # Blocks while the workers are behind, holding back further events
+        self.message_queue.put(msg)
+
+    def _process_messages(self):
+        while True:
+            msg = self.message_queue.get()
+            if msg is None:
+                return
+            try:
+                self.callback_message(msg)
+            except Exception:
+                log.exception("Failed to process message")
+
+    def _start_message_workers(self):
+        for i in range(self.message_workers):
+            thread = threading.Thread(target=self._process_messages,
+                                      name=f'ghc-message-{i}', daemon=True)
+            thread.start()
+            self.message_threads.append(thread)
+
+    def _stop_message_workers(self):
+        # Queued messages are handled first, but a hung command can't block shutdown
+        deadline = time.monotonic() + self.message_shutdown_timeout
+        try:
+            for _ in self.message_threads:
+                self.message_queue.put(None, timeout=max(0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        for thread in self.message_threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                log.warning("Message worker {} did not finish within {}s".format(
+                    thread.name, self.message_shutdown_timeout))
+        self.message_threads = []
+        # Unblock any event callback still waiting for room in the queue
+        dropped = 0
+        try:
+            while True:
+                if self.message_queue.get_nowait() is not None:
+                    dropped += 1
+        except queue.Empty:
+            pass
+        if dropped:
+            log.warning("Dropped {} unprocessed messages".format(dropped))
+
+    def _convert_markdown(self, body):
+        # Plain text comes out of the converter unchanged
+        if not MARKDOWN_TOKENS_REGEX.search(body):
+            return body
+        with self.md_lock:
+            text = self.md_cache.get(body)
+            if text is None:
+                text = self.md.convert(body)
+                self.md_cache[body] = text
+        return text
 
     def _split_message(self, text, maximum_message_length=GoogleHangoutsChatAPI.max_message_length):
         '''
         Splits a given string up into multiple strings all of length less than some maximum size
 
-        Edge Case: We don't handle the case where one line is big enough for a whole message
+        A line too big for a whole message is broken up into message sized pieces.
+        Returns (offset, part) pairs, where offset is where the part starts in text
         '''
-        lines = text.split('\n')
+        # Most replies fit in a single message, skip splitting them into lines
+        if len(text) < maximum_message_length:
+            return [(0, text + '\n')]
+
+        # Every line is sent with its trailing newline
+        max_line_length = maximum_message_length - 1
+        lines = []
+        offset = 0
+        for line in text.split('\n'):
+            while len(line) > max_line_length:
+                lines.append((offset, line[:max_line_length]))
+                line = line[max_line_length:]
+                offset += max_line_length
+            lines.append((offset, line))
+            offset += len(line) + 1
+
         messages = []
-        current_message = ''
-        for line in lines:
-            if len(current_message) + len(line) + 1 > maximum_message_length:
-                messages.append(current_message)
-                current_message = line + '\n'
-            else:
-                current_message += line + '\n'
-
-        messages.append(current_message)
+        current_lines = []
+        current_offset = 0
+        current_length = 0
+        for offset, line in lines:
+            line_length = len(line) + 1
+            if current_length + line_length > maximum_message_length and current_lines:
+                messages.append((current_offset, '\n'.join(current_lines) + '\n'))
+                current_lines = []
+                current_length = 0
+            if not current_lines:
+                current_offset = offset
+            current_lines.append(line)
+            current_length += line_length
+
+        messages.append((current_offset, '\n'.join(current_lines) + '\n'))
         return messages
 
+    def _submit_send(self, space_id, send, *args):
+        """
+        Runs send(*args) on the send pool once everything previously submitted
+        for the same space has been sent.
+        """
+        future = Future()
+        with self.pending_sends_lock:
+            sends = self.pending_sends.get(space_id)
+            idle = sends is None
+            if idle:
+                sends = self.pending_sends[space_id] = deque()
+            sends.append((future, send, args))
+        if idle:
+            try:
+                self.send_pool.submit(self._run_sends, space_id)
+            except RuntimeError:
+                with self.pending_sends_lock:
+                    del self.pending_sends[space_id]
+                raise
+        return future
+
+    def _run_sends(self, space_id):
+        """
+        Sends the oldest pending message for a space, then puts the space back on
+        the pool if more are waiting, so spaces take turns on the workers
+        """
+        while True:
+            with self.pending_sends_lock:
+                future, send, args = self.pending_sends[space_id][0]
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(send(*args))
+                except Exception as e:
+                    log.error("Failed to send message to {}".format(space_id), exc_info=e)
+                    future.set_exception(e)
+            with self.pending_sends_lock:
+                sends = self.pending_sends[space_id]
+                sends.popleft()
+                if not sends:
+                    del self.pending_sends[space_id]
+                    return
+            try:
+                self.send_pool.submit(self._run_sends, space_id)
+                return
+            except RuntimeError:
+                # The pool is shutting down, finish this space's sends on this thread
+                continue
+
+    def _create_message(self, space_id, message_payload, thread_state=None, thread_key=None):
+        gc = self.chat_api.create_message(space_id, message_payload, thread_state, thread_key)
+
+        # record sent message success or failure
+        if self.prometheus is not None:
+            self.prometheus.inc('message_sent', 'failure' if gc == None else 'success')
+        return gc
+
     def prep_message_context(self, message):
         space_id = message.extras.get('space_id', None)
         thread_id = message.extras.get('thread_id', None)
@@ -400,48 +807,70 @@ class GoogleHangoutsChatBackend(ErrBot):
         mentions = message.extras.get('mentions', None)
         text = message.body
         if convert_markdown:
-            text = self.md.convert(message.body)
+            text = self._convert_markdown(message.body)
         sub_messages = self._split_message(text)
         log.info("Split message into {} parts".format(len(sub_messages)))
-        for message in sub_messages:
-            message_payload = {
-                'text': message
-            }
-            if mentions:
-                message_payload['annotations'] = []
-                for mention in mentions:
-                    message_payload['annotations'].append(
-                        {
-                            "type": "USER_MENTION",
-                            "startIndex": mention['start'],
-                            "length": mention['length'],
-                            "userMention": {
-                                "user": {
-                                    "name": mention['user_id'],
-                                    "displayName": mention['display_name'],
-                                    "type": "HUMAN"
-                                },
-                                "type": "ADD"
-                            }
-                        }
-                    )
-            if thread_id:
-                message_payload['thread'] = {'name': thread_id}
-
-            gc = self.chat_api.create_message(space_id, message_payload, thread_state, thread_key)
-
-            # record sent message success or failure
-            if self.prometheus is not None and self.prometheus.metric('message_sent'):
-                self.prometheus.metric('message_sent').labels(status=('failure' if gc == None else 'success')).inc()
-
-            # errbot expects no return https://errbot.readthedocs.io/en/latest/errbot.core.html#errbot.core.ErrBot.send_message
-            # but we need this in order to get the thread_id from a thread_key generated message
-
-            return None if gc == None else {
-                'space_id': gc.get('space', {}).get('name', ''),
-                'thread_id': gc.get('thread', {}).get('name', ''),
-                'thread_key': thread_key
-            }
+        mention_annotations = []
+        for mention in mentions or []:
+            mention_annotations.append(
+                {
+                    "type": "USER_MENTION",
+                    "startIndex": mention['start'],
+                    "length": mention['length'],
+                    "userMention": {
+                        "user": {
+                            "name": mention['user_id'],
+                            "displayName": mention['display_name'],
+                            "type": "HUMAN"
+                        },
+                        "type": "ADD"
+                    }
+                }
+            )
+        # Fields shared by every part, the nested thread dict is shared rather than copied
+        base_payload = {}
+        if thread_id:
+            base_payload['thread'] = {'name': thread_id}
+        message_payloads = []
+        # Each part covers the text up to where the next one starts. Long lines are broken
+        # with an added newline, so the part lengths don't add up to their offsets
+        ends = [offset for offset, _ in sub_messages[1:]] + [len(text)]
+        for (offset, message), end in zip(sub_messages, ends):
+            message_payload = {**base_payload, 'text': message}
+            # Mention indexes are into the whole text, so each one goes only on the part
+            # that contains it, relative to the start of that part
+            annotations = [
+                annotation if offset == 0 else {**annotation, 'startIndex': annotation['startIndex'] - offset}
+                for annotation in mention_annotations
+                if offset <= annotation['startIndex'] and
+                annotation['startIndex'] + annotation['length'] <= end
+            ]
+            if annotations:
+                message_payload['annotations'] = annotations
+            message_payloads.append(message_payload)
+
+        # Only the first part is waited on, the remaining parts are posted in the background
+        gc = self._submit_send(space_id, self._create_message,
+                               space_id, message_payloads[0], thread_state, thread_key).result()
+        remaining_payloads = message_payloads[1:]
+        # Without a thread to reply to, keep the remaining parts in the thread the first part started
+        if remaining_payloads and not thread_id and thread_key is None and gc is not None:
+            first_thread_id = gc.get('thread', {}).get('name')
+            if first_thread_id:
+                remaining_payloads = [{**message_payload, 'thread': {'name': first_thread_id}}
+                                      for message_payload in remaining_payloads]
+        for message_payload in remaining_payloads:
+            self._submit_send(space_id, self._create_message,
+                              space_id, message_payload, thread_state, thread_key)
+
+        # errbot expects no return https://errbot.readthedocs.io/en/latest/errbot.core.html#errbot.core.ErrBot.send_message
+        # but we need this in order to get the thread_id from a thread_key generated message
+
+        return None if gc == None else {
+            'space_id': gc.get('space', {}).get('name', ''),
+            'thread_id': gc.get('thread', {}).get('name', ''),
+            'thread_key': thread_key
+        }
 
     # Legacy send_card signature.  This is being deprecated in favor of errbot upstream signature that matches other built-in plugins.
     def send_card_deprecated(self, cards, space_id, thread_id=None):
@@ -452,7 +881,7 @@ class GoogleHangoutsChatBackend(ErrBot):
         if thread_id:
             message_payload['thread'] = {'name': thread_id}
 
-        self.chat_api.create_message(space_id, message_payload)
+        self._submit_send(space_id, self.chat_api.create_message, space_id, message_payload)
 
     # Creates a message body following the card format described in google dev docs
     # https://developers.google.com/chat/reference/message-formats/cards
@@ -488,7 +917,7 @@ class GoogleHangoutsChatBackend(ErrBot):
         if not errbot_card.body:
             raise MalformedCardError(errbot_card, "'body' field required")
 
-        ghc_card['sections'] = json.loads(errbot_card.body)
+        ghc_card['sections'] = json_loads(errbot_card.body)
         # Example of 'sections' body string:
         # https://developers.google.com/chat/reference/message-formats/cards
         #
@@ -544,9 +973,10 @@ class GoogleHangoutsChatBackend(ErrBot):
         if thread_id:
             message_payload['thread'] = {'name': thread_id}
 
-        self.chat_api.create_message(space_id, message_payload, thread_state, thread_key)
+        self._submit_send(space_id, self.chat_api.create_message, space_id, message_payload, thread_state, thread_key)
 
     def serve_forever(self):
+        self._start_message_workers()
         subscription = self._subscribe_to_pubsub_topic(self.gce_project,
                                                        self.gce_topic,
                                                        self.gce_subscription,
@@ -557,13 +987,23 @@ class GoogleHangoutsChatBackend(ErrBot):
             self.prometheus.start_server()
 
         try:
-            import time
-            while True:
-                time.sleep(10)
+            # Block until the streaming pull terminates instead of polling
+            subscription.result()
         except KeyboardInterrupt:
             log.info("Exiting")
+            subscription.cancel()
+            try:
+                subscription.result(timeout=self.pubsub_shutdown_timeout)
+            except TimeoutError:
+                log.warning("Pub/Sub subscriber did not shut down within {}s".format(self.pubsub_shutdown_timeout))
         finally:
+            self._stop_message_workers()
             self.disconnect_callback()
+            self.send_pool.shutdown(wait=True)
+            if self.subscriber is not None:
+                self.subscriber.close()
+                self.subscriber = None
+            self.chat_api.close()
             self.shutdown()
 
     def build_identifier(self, strrep):
@@ -581,11 +1021,29 @@ class GoogleHangoutsChatBackend(ErrBot):
         return 'Google_Hangouts_Chat'
 
     def query_room(self, room):
-        return HangoutsChatRoom(room, self.chat_api)
+        with self.room_cache_lock:
+            hangouts_room = self.room_cache.get(room)
+        if hangouts_room is None:
+            hangouts_room = HangoutsChatRoom(room, self.chat_api)
+            with self.room_cache_lock:
+                self.room_cache[room] = hangouts_room
+        return hangouts_room
+
+    def invalidate_room(self, room):
+        """
+        Drops a cached room, e.g. after its space metadata has been changed
+        """
+        with self.room_cache_lock:
+            self.room_cache.pop(room, None)
 
     def rooms(self):
-        spaces = self.chat_api.get_spaces()
-        rooms = ['{} ({})'.format(space['displayName'], space['name'])
-                 for space in list(spaces) if space['type'] == 'ROOM']
+        return list(self.iter_rooms())
 
-        return rooms
+    def iter_rooms(self):
+        """
+        Lazily yields rooms as pages of spaces arrive, so callers looking for a
+        particular room can stop without listing every space
+        """
+        for space in self.chat_api.get_spaces():
+            if space['type'] == 'ROOM':
+                yield f"{space['displayName']} ({space['name']})"
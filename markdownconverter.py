@@ -26,7 +26,7 @@ from markdown.extensions.extra import ExtraExtension
 from markdown.preprocessors import Preprocessor
 from errbot.rendering.ansiext import AnsiExtension, enable_format, IMTEXT_CHRS
 
-MARKDOWN_LINK_REGEX = re.compile(r'(?<!!)\[(?P<text>[^\]]+?)\]\((?P<uri>[a-zA-Z0-9]+?:\S+?)\)')
+MARKDOWN_LINK_REGEX = re.compile(r'(?<!!)\[(?P<text>[^\]\n]+?)\]\((?P<uri>[a-zA-Z0-9]+?:\S+?)\)')
 
 
 def hangoutschat_markdown_converter(compact_output=False):
@@ -48,6 +48,8 @@ class LinkPreProcessor(Preprocessor):
     section "Linking to URLs".
     """
     def run(self, lines):
-        for i, line in enumerate(lines):
-            lines[i] = MARKDOWN_LINK_REGEX.sub(r'&lt;\2|\1&gt;', line)
-        return lines
+        text = '\n'.join(lines)
+        # Most messages have no links at all, so skip the regex for them
+        if '](' not in text:
+            return lines
+        return MARKDOWN_LINK_REGEX.sub(r'&lt;\2|\1&gt;', text).split('\n')
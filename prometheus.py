@@ -11,6 +11,11 @@ class PrometheusMetrics:
             "message_sent": Counter(f"{self._name}_message_sent","The number of sent messages by result status", ['status']),
             # New metrics can be defined here
         }
+        # Labelled children are resolved up front so hot paths skip the label lookup
+        self._children = {
+            "message_sent": {status: self._metrics["message_sent"].labels(status=status)
+                             for status in ('success', 'failure')},
+        }
         self._log.info(f"Found {len(self._metrics)} configured prometheus metrics")
 
     def normalize_name(self, name):
@@ -21,6 +26,9 @@ class PrometheusMetrics:
     
     def metrics(self):
         return self._metrics
+
+    def inc(self, name, status):
+        self._children[name][status].inc()
     
     def start_server(self):
         start_http_server(self._port)